@@ -14,17 +14,14 @@
 
 """Tabular Q-learning agent."""
 
-import collections
+from collections import deque
+import functools
 import numpy as np
 
+import pyspiel
 from open_spiel.python import rl_agent
 from open_spiel.python import rl_tools
 
-try:
-    from IPython import embed
-except:
-    pass
-
 
 # reward_mask = np.array([[0, 1, 0],
 #                         [1, 0, 1],
@@ -42,22 +39,118 @@ except:
 #     return 1000
 #
 
+# Place values of the nine board cells in the base-3 state key, and in the
+# 9-bit key of a single player's 0/1 occupancy board.
+POW3 = 3 ** np.arange(9, dtype=np.int32)
+POW2_9 = 1 << np.arange(9, dtype=np.int16)
+
+# The 8 symmetries of the board (4 rotations, each optionally mirrored) as
+# cell permutations: `board[SYMS[k]]` is the k-th transformed board, whose
+# cell i holds the original cell SYMS[k][i]. INV_SYMS maps cells back.
+_CELLS = np.arange(9).reshape(3, 3)
+SYMS = np.array(
+    [np.rot90(cells, k).ravel() for cells in (_CELLS, np.fliplr(_CELLS)) for k in range(4)],
+    dtype=np.intp,
+)
+INV_SYMS = np.argsort(SYMS, axis=1)
+
+
 def info_state_to_board(time_step):
-    info_state = time_step.observations["info_state"][0]
-    x_locations = np.nonzero(info_state[9:18])[0]
-    o_locations = np.nonzero(info_state[18:])[0]
-    board = np.full(3 * 3, 0)
-    board[x_locations] = 1
-    board[o_locations] = -1
-    board = np.reshape(board, (3, 3))
-    return board
+    info_state = np.asarray(time_step.observations["info_state"][0], dtype=np.int8)
+    return (info_state[9:18] - info_state[18:27]).reshape(3, 3)
+
+
+def encode_boards(boards):
+    """Packs boards of base-3 cell digits, one per row, into an array of keys."""
+    return boards.dot(POW3)
+
+
+def encode_board(board):
+    """Packs a flat board of base-3 cell digits into its int key."""
+    return int(encode_boards(board))
+
+
+def encode_occupancy(board):
+    """Packs a flat 0/1 board of one player's cells into a 9-bit int key."""
+    return int(board.dot(POW2_9))
+
+
+def info_state_to_key(info_state):
+    """Packs a tic-tac-toe info state into a single int key.
+
+    Every cell is reduced to 0 (empty), 1 (X) or 2 (O) and the nine cells are
+    read as the digits of a base-3 number, so the key is in [0, 3**9).
+    """
+    return encode_board(_ternary_board(info_state))
+
+
+def info_state_to_canonical_key(info_state):
+    """Packs an info state into the smallest key among its 8 symmetric boards.
+
+    Returns:
+      The canonical key and the index `k` of the symmetry that produced it, so
+      that cell i of the canonical board is cell `SYMS[k][i]` of the original.
+    """
+    keys = encode_boards(_ternary_board(info_state)[SYMS])
+    sym = int(np.argmin(keys))
+    return int(keys[sym]), sym
+
+
+def _ternary_board(info_state):
+    x = np.asarray(info_state[9:18], dtype=np.uint8)
+    o = np.asarray(info_state[18:27], dtype=np.uint8)
+    return x + 2 * o
 
 
-def valuedict():
-    #: The default factory is called without arguments to produce a new value when a key is not present,
-    # in __getitem__ only.
-    #: This value is added to the dict, so modifying it will modify the dict.
-    return collections.defaultdict(float)
+def _td_update(q_prev, a_prev, q_next_max, reward, alpha, gamma):
+    """Applies one Q-learning update to `q_prev[a_prev]` in place.
+
+    `q_next_max` is 0 after a terminal step, so the target reduces to the
+    reward there. Returns the loss, i.e. the updated Q-value minus the target.
+    """
+    target = reward + gamma * q_next_max
+    q_prev[a_prev] += alpha * (target - q_prev[a_prev])
+    return q_prev[a_prev] - target
+
+
+@functools.lru_cache(maxsize=None)
+def reachable_state_index(symmetric=True):
+    """Perfect hash from board keys to dense rows of the Q table.
+
+    Walks every board reachable from the empty one and numbers them in
+    visiting order, either up to symmetry (765 classes) or one by one (5478).
+
+    Args:
+      symmetric: bool, whether the keys are canonical keys, see
+        `info_state_to_canonical_key`, or plain ones, see `info_state_to_key`.
+
+    Returns:
+      A read-only int32 array of length 3**9 mapping a key to its row (-1 for
+      other keys) and the number of rows.
+    """
+    if symmetric:
+        board_key = lambda info_state: info_state_to_canonical_key(info_state)[0]
+    else:
+        board_key = info_state_to_key
+    game = pyspiel.load_game("tic_tac_toe")
+    state_index = np.full(3 ** 9, -1, dtype=np.int32)
+    num_states = 0
+    frontier = deque([game.new_initial_state()])
+    state_index[board_key(frontier[0].observation_tensor(0))] = num_states
+    num_states += 1
+    while frontier:
+        state = frontier.popleft()
+        if state.is_terminal():
+            continue
+        for action in state.legal_actions():
+            child = state.child(action)
+            key = board_key(child.observation_tensor(0))
+            if state_index[key] < 0:
+                state_index[key] = num_states
+                num_states += 1
+                frontier.append(child)
+    state_index.flags.writeable = False
+    return state_index, num_states
 
 
 class QLearner(rl_agent.AbstractAgent):
@@ -72,8 +165,24 @@ class QLearner(rl_agent.AbstractAgent):
             discount_factor=1.0,
             rules=None,
             centralized=False,
+            perfect_hash=False,
+            initial_rows=1024,
+            symmetric=None,
+            seed=None,
     ):
-        """Initialize the Q-Learning agent."""
+        """Initialize the Q-Learning agent.
+
+        `perfect_hash` is only valid for tic-tac-toe: the Q table then has one
+        row per reachable board, or per board up to symmetry if `symmetric` is
+        set. `symmetric` defaults to whether there are no `rules`, since extra
+        rewards such as a fixed pattern usually depend on the board's
+        orientation. Without `perfect_hash` rows are appended on first visit of
+        an info state, starting from `initial_rows` and doubling when full,
+        which works for any game; `symmetric` has no effect in that mode.
+
+        `seed` seeds the agent's own random generator, which drives
+        exploration, so training is repeatable.
+        """
         self._player_id = player_id
         self._num_actions = num_actions
         self._step_size = step_size
@@ -81,55 +190,90 @@ class QLearner(rl_agent.AbstractAgent):
         self._epsilon = epsilon_schedule.value
         self._discount_factor = discount_factor
         self._centralized = centralized
-        self._q_values = collections.defaultdict(valuedict)
+        self._perfect_hash = perfect_hash
+        self._symmetric = rules is None if symmetric is None else symmetric
+        if perfect_hash:
+            # One float32 row of Q-values per reachable state, so lookups are
+            # plain array indexing. With `symmetric` an update made in one board
+            # orientation is shared by all eight and rows are in the canonical
+            # frame.
+            self._state_index, self._num_rows = reachable_state_index(self._symmetric)
+            self._q_values = np.zeros((self._num_rows, num_actions), dtype=np.float32)
+        else:
+            self._num_rows = 0
+            self._q_values = np.zeros((initial_rows, num_actions), dtype=np.float32)
         self._prev_info_state = None
         self._last_loss_value = None
         self._prev_action = None
         self._rules = rules
-
-    def _epsilon_greedy(self, info_state, legal_actions, epsilon):
+        self._rng = np.random.default_rng(seed)
+        # Raw info states are memoized on their tuple form, which hashes several
+        # times faster than canonicalizing the board with numpy on every step.
+        # Maps to (row, symmetry), with no symmetry unless `symmetric`.
+        self._row_cache = {}
+        # Legal actions only depend on the board, so they are converted to an
+        # index array (in the canonical frame when `symmetric`) once per state
+        # and reused on every revisit.
+        self._legal_cache = {}
+
+    def _add_row(self):
+        """Returns a fresh zeroed Q row, doubling the table if it is full."""
+        if self._num_rows == len(self._q_values):
+            self._q_values = np.concatenate([self._q_values, np.zeros_like(self._q_values)])
+        self._num_rows += 1
+        return self._num_rows - 1
+
+    def _epsilon_greedy(self, info_state, legal_actions, epsilon, return_probs=True):
         """Returns a valid epsilon-greedy action and valid action probs. (goes to a non-greedy state with probability epsilon, and to a greedy state with probability 1-epsilon)
 
         If the agent has not been to `info_state`, a valid random action is chosen.
 
         Args:
-          info_state: hashable representation of the information state.
-          legal_actions: list of actions at `info_state`.
+          info_state: row of the information state in the Q table.
+          legal_actions: index array of actions at `info_state`.
           epsilon: float, prob of taking an exploratory action.
+          return_probs: bool, whether to build the action probabilities. The
+            training loop only needs the action, so it skips the allocation.
 
         Returns:
-          A valid epsilon-greedy action and valid action probabilities.
+          A valid epsilon-greedy action and valid action probabilities (None
+          if `return_probs` is False).
         """
-        probs = np.zeros(self._num_actions)
+        probs = None
 
-        if np.random.random() < epsilon:
+        if self._rng.random() < epsilon:
             # probs for every action is same
-            probs[legal_actions] = 1 / len(legal_actions)
+            action = int(legal_actions[self._rng.integers(len(legal_actions))])
+            if return_probs:
+                probs = np.zeros(self._num_actions)
+                probs[legal_actions] = 1 / len(legal_actions)
 
         else:
             # probs for action with most q-value is 1, and 0 for others
-            q_values = np.array([self._q_values[info_state][a] for a in legal_actions])
-            best_action = legal_actions[np.argmax(q_values)]
-            probs[best_action] = 1
+            q_values = self._q_values[info_state]
+            action = int(legal_actions[np.argmax(q_values[legal_actions])])
+            if return_probs:
+                probs = np.zeros(self._num_actions)
+                probs[action] = 1
 
-        action = np.random.choice(range(self._num_actions), p=probs)
         return action, probs
 
-    def _get_action_probs(self, info_state, legal_actions, epsilon):
+    def _get_action_probs(self, info_state, legal_actions, epsilon, return_probs=True):
         """Returns a selected action and the probabilities of legal actions.
 
         To be overwritten by subclasses that implement other action selection
         methods.
 
         Args:
-          info_state: hashable representation of the information state.
-          legal_actions: list of actions at `info_state`.
+          info_state: row of the information state in the Q table.
+          legal_actions: index array of actions at `info_state`.
           epsilon: float: current value of the epsilon schedule or 0 in case
             evaluation. QLearner uses it as the exploration parameter in
             epsilon-greedy, but subclasses are free to interpret in different ways
             (e.g. as temperature in softmax).
+          return_probs: bool, whether the caller needs the action probabilities.
         """
-        return self._epsilon_greedy(info_state, legal_actions, epsilon)
+        return self._epsilon_greedy(info_state, legal_actions, epsilon, return_probs)
 
     def _get_action_reward(self, time_step):
         """Returns the action reward.
@@ -145,70 +289,104 @@ class QLearner(rl_agent.AbstractAgent):
                 # rules is array of rule which each of it is a lambda function which takes a board and returns a reward
                 # iterate over rules and sum up the rewards
                 board = time_step.observations["info_state"][0]
-                current_player_board = board[9:18] if self._player_id == 0 else board[18:]
-                # convert to int
-                current_player_board = np.array(current_player_board, dtype=int)
-                extra_reward = sum([rule(current_player_board) for rule in self._rules])
+                current_player_board = np.asarray(
+                    board[9:18] if self._player_id == 0 else board[18:27], dtype=np.uint8
+                )
+                extra_reward = sum(rule(current_player_board) for rule in self._rules)
 
             return time_step.rewards[self._player_id] + extra_reward
 
-    def step(self, time_step, is_evaluation=False, top1=False):
+    def step(self, time_step, is_evaluation=False, top1=False, return_probs=False):
         """Returns the action to be taken and updates the Q-values if needed.
 
         Args:
           time_step: an instance of rl_environment.TimeStep.
           is_evaluation: bool, whether this is a training or evaluation call.
           top1: bool, whether to use top1 or topk for the loss.
+          return_probs: bool, whether to fill in the action probs of the
+            output; they are None otherwise.
         Returns:
           A `rl_agent.StepOutput` containing the action probs and chosen action.
         """
-        if self._centralized:
-            info_state = str(time_step.observations["info_state"])
+        info_states = time_step.observations["info_state"]
+        if not self._centralized:
+            raw_info_state = info_states[self._player_id]
+        elif self._perfect_hash:
+            # The board is fully observed, so every player shares the same view.
+            raw_info_state = info_states[0]
         else:
-            info_state = str(time_step.observations["info_state"][self._player_id])
+            raw_info_state = [x for info_state in info_states for x in info_state]
+
+        state = tuple(raw_info_state)
+        cached = self._row_cache.get(state)
+        if cached is None:
+            if self._perfect_hash:
+                if self._symmetric:
+                    key, sym = info_state_to_canonical_key(raw_info_state)
+                else:
+                    key, sym = info_state_to_key(raw_info_state), None
+                row = int(self._state_index[key])
+                if row < 0:
+                    raise ValueError(f"Board key {key} is not reachable in tic-tac-toe")
+                cached = (row, sym)
+            else:
+                cached = (self._add_row(), None)
+            self._row_cache[state] = cached
+        info_state, sym = cached
+
+        legal_actions = self._legal_cache.get(info_state)
+        if legal_actions is None:
+            legal_actions = np.asarray(time_step.observations["legal_actions"][self._player_id], dtype=np.intp)
+            if sym is not None:
+                legal_actions = np.sort(INV_SYMS[sym][legal_actions])
+            self._legal_cache[info_state] = legal_actions
 
-        legal_actions = time_step.observations["legal_actions"][self._player_id]
+        terminal = time_step.last()
 
         # Prevent undefined errors if this agent never plays until terminal step
-        action, probs = None, None
+        action, probs, table_action = None, None, None
 
         # Act step: don't act at terminal states.
-        if not time_step.last():
-            epsilon = 0.0 if is_evaluation else self._epsilon
-            action, probs = self._get_action_probs(info_state, legal_actions, epsilon)
-            if top1 or is_evaluation:
-                action = np.argmax(probs)
+        if not terminal:
+            # With epsilon 0 the choice already is the argmax of the Q-values.
+            epsilon = 0.0 if top1 or is_evaluation else self._epsilon
+            table_action, probs = self._get_action_probs(info_state, legal_actions, epsilon, return_probs)
+            if sym is None:
+                action = int(table_action)
+            else:
+                # Map the canonical-frame choice back onto the actual board.
+                action = int(SYMS[sym][table_action])
+                if probs is not None:
+                    probs = probs[INV_SYMS[sym]]
 
         # Learn step: don't learn during evaluation or at first agent steps.
-        if self._prev_info_state and not is_evaluation:
+        if self._prev_info_state is not None and not is_evaluation:
             # Update q-values using the previous info state and action.
             reward = self._get_action_reward(time_step)
 
-            if time_step.last():
-                target = reward
-            else:
-                target = reward + self._discount_factor * max(
-                    [self._q_values[info_state][a] for a in legal_actions]
-                )
-
-            self._q_values[self._prev_info_state][self._prev_action] += self._step_size * (
-                    target - self._q_values[self._prev_info_state][self._prev_action]
+            q_values = self._q_values
+            q_next_max = 0.0 if terminal else float(q_values[info_state][legal_actions].max())
+
+            # Update q-value and loss value
+            self._last_loss_value = _td_update(
+                q_values[self._prev_info_state],
+                self._prev_action,
+                q_next_max,
+                float(reward),
+                self._step_size,
+                self._discount_factor,
             )
 
-            # Update loss value
-            self._last_loss_value = self._q_values[self._prev_info_state][self._prev_action] - target
-
-            # Decay epsilon, if necessary.
-            self._epsilon = self._epsilon_schedule.step()
-
-            if time_step.last():  # prepare for the next episode.
+            if terminal:  # prepare for the next episode.
+                # Decay epsilon, if necessary (once per episode).
+                self._epsilon = self._epsilon_schedule.step()
                 self._prev_info_state = None
                 return
 
         # Don't mess up with the state during evaluation.
         if not is_evaluation:
             self._prev_info_state = info_state
-            self._prev_action = action
+            self._prev_action = table_action
         return rl_agent.StepOutput(action=action, probs=probs)
 
 # Local Variables:
@@ -28,11 +28,11 @@ from absl import app
 from absl import flags
 import numpy as np
 
+from open_spiel.python import rl_agent
 from open_spiel.python import rl_environment
 from open_spiel.python import rl_tools
-from open_spiel.python.algorithms import random_agent
 
-from tabular_qlearner import QLearner
+from tabular_qlearner import QLearner, encode_occupancy
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 
@@ -47,30 +47,52 @@ flags.DEFINE_boolean(
 
 reward_mask = np.array([[0, 1, 0],
                         [1, 0, 1],
-                        [0, 0, 0]])
+                        [0, 0, 0]], dtype=np.int8)
 
 flat_reward_mask = np.reshape(reward_mask, (9,))
 
+# A player's board is a 0/1 occupancy vector, so it packs into 9 bits and the
+# mask comparison becomes a single int compare.
+LIKEABLE_KEY = encode_occupancy(flat_reward_mask)
+
 
 def likeable_pattern(board):
     """Returns a reward if the board is likeable and 0 otherwise."""
-    for i in range(9):
-        if board[i] != flat_reward_mask[i]:
-            return 0
+    return 1000 if encode_occupancy(board) == LIKEABLE_KEY else 0
+
 
-    return 1000
+# Symbols of empty, X and 0 cells, indexed by the cell's base-3 digit.
+BOARD_SYMBOLS = np.array([".", "X", "0"])
 
 
 def pretty_board(time_step):
     """Returns the board in `time_step` in a human-readable format."""
-    info_state = time_step.observations["info_state"][0]
-    x_locations = np.nonzero(info_state[9:18])[0]
-    o_locations = np.nonzero(info_state[18:])[0]
-    board = np.full(3 * 3, ".")
-    board[x_locations] = "X"
-    board[o_locations] = "0"
-    board = np.reshape(board, (3, 3))
-    return board
+    info_state = np.asarray(time_step.observations["info_state"][0], dtype=np.int8)
+    return BOARD_SYMBOLS[info_state[9:18] + 2 * info_state[18:27]].reshape(3, 3)
+
+
+class FastRandomAgent(rl_agent.AbstractAgent):
+    """Uniformly random agent for evaluation.
+
+    Same policy as `random_agent.RandomAgent`, but draws from one Generator
+    held on the agent and skips building the action probabilities, which the
+    evaluation loop never reads.
+    """
+
+    def __init__(self, player_id, num_actions, seed=None):
+        assert num_actions > 0
+        self._player_id = player_id
+        self._num_actions = num_actions
+        self._rng = np.random.default_rng(seed)
+
+    def step(self, time_step, is_evaluation=False):
+        # If it is the end of the episode, don't select an action.
+        if time_step.last():
+            return
+
+        legal_actions = time_step.observations["legal_actions"][self._player_id]
+        action = legal_actions[self._rng.integers(len(legal_actions))]
+        return rl_agent.StepOutput(action=action, probs=None)
 
 
 def command_line_action(time_step):
@@ -95,25 +117,26 @@ def eval_against_random_bots(
     """Evaluates `trained_agents` against `random_agents` for `num_episodes`."""
     wins = np.zeros(2)
     losses = np.zeros(2)
+    time_steps = []
     for player_pos in range(2):
         if player_pos == 0:
             cur_agents = [trained_agents[0], random_agents[1]]
+            cur_opts = [{"top1": top1}, {}]
         else:
             cur_agents = [random_agents[0], trained_agents[1]]
+            cur_opts = [{}, {"top1": top1}]
 
         for _ in range(num_episodes):
-            time_steps = []
+            time_steps.clear()
             time_step = env.reset()
             while not time_step.last():
                 player_id = time_step.observations["current_player"]
-                opts = dict()
-                if player_id == player_pos:
-                    opts["top1"] = top1
                 agent_output = cur_agents[player_id].step(
-                    time_step, is_evaluation=True, **opts
+                    time_step, is_evaluation=True, **cur_opts[player_id]
                 )
                 time_step = env.step([agent_output.action])
-                time_steps.append(time_step)
+                if show_non_wins:
+                    time_steps.append(time_step)
 
             reward = time_step.rewards[player_pos]
             if reward > 0:
@@ -150,14 +173,15 @@ def main(_):
                 0.2,
             ),
             discount_factor=0.6,
-            rules=[likeable_pattern]
+            rules=[likeable_pattern],
+            perfect_hash=True,
         )
         for idx in range(num_players)
     ]
 
     # random agents for evaluation
     random_agents = [
-        random_agent.RandomAgent(player_id=idx, num_actions=num_actions)
+        FastRandomAgent(player_id=idx, num_actions=num_actions)
         for idx in range(num_players)
     ]
 
@@ -206,7 +230,7 @@ def main(_):
         while not time_step.last():
             player_id = time_step.observations["current_player"]
             if player_id == human_player:
-                agent_out = agents[human_player].step(time_step, is_evaluation=True)
+                agent_out = agents[human_player].step(time_step, is_evaluation=True, return_probs=True)
                 logging.info(
                     "\nagent suggests these actions with these probabilities:\n%s",
                     agent_out.probs.reshape((3, 3)),